@@ -0,0 +1,69 @@
+import importlib
+import pytest
+from datasets import Dataset
+from wft.prepare_dataset import load_streaming_dataset
+
+# the package re-exports the prepare_dataset function under the module's name
+wft_prepare_dataset = importlib.import_module("wft.prepare_dataset")
+
+
+README = """---
+dataset_info:
+  features:
+  - name: x
+    dtype: int64
+  splits:
+  - name: train
+    num_bytes: 240
+    num_examples: 30
+  - name: validation
+    num_bytes: 80
+    num_examples: 10
+---
+"""
+
+
+@pytest.fixture
+def local_dataset(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    Dataset.from_dict({"x": list(range(30))}).to_parquet(
+        str(data / "train-00000-of-00001.parquet")
+    )
+    Dataset.from_dict({"x": list(range(100, 110))}).to_parquet(
+        str(data / "validation-00000-of-00001.parquet")
+    )
+    return tmp_path
+
+
+@pytest.fixture
+def probabilities(monkeypatch):
+    recorded = []
+    interleave_datasets = wft_prepare_dataset.interleave_datasets
+
+    def record(*args, **kwargs):
+        recorded.append(kwargs["probabilities"])
+        return interleave_datasets(*args, **kwargs)
+
+    monkeypatch.setattr(wft_prepare_dataset, "interleave_datasets", record)
+    return recorded
+
+
+def test_load_streaming_dataset_unsized_splits(local_dataset, probabilities):
+    dataset = load_streaming_dataset(
+        str(local_dataset), None, split="train+validation", trust_remote_code=True
+    )
+
+    assert probabilities == [[0.5, 0.5]]
+    assert {row["x"] for row in dataset} == set(range(30)) | set(range(100, 110))
+
+
+def test_load_streaming_dataset_sized_splits(local_dataset, probabilities):
+    (local_dataset / "README.md").write_text(README)
+
+    dataset = load_streaming_dataset(
+        str(local_dataset), None, split="train+validation", trust_remote_code=True
+    )
+
+    assert probabilities == [[0.75, 0.25]]
+    assert {row["x"] for row in dataset} == set(range(30)) | set(range(100, 110))
@@ -0,0 +1,40 @@
+import os
+from wft import parallel_rmtree
+
+
+def test_parallel_rmtree(tmp_path):
+    root = tmp_path / "tree"
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "a" / "b" / "file.txt").write_text("content")
+    (root / "file.txt").write_text("content")
+
+    parallel_rmtree(str(root))
+
+    assert not root.exists()
+
+
+def test_parallel_rmtree_symlinked_root(tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+    (target / "file.txt").write_text("content")
+    link = tmp_path / "link"
+    os.symlink(target, link)
+
+    parallel_rmtree(str(link))
+
+    assert not os.path.lexists(link)
+    assert (target / "file.txt").read_text() == "content"
+
+
+def test_parallel_rmtree_symlinked_subdir(tmp_path):
+    target = tmp_path / "target"
+    target.mkdir()
+    (target / "file.txt").write_text("content")
+    root = tmp_path / "tree"
+    root.mkdir()
+    os.symlink(target, root / "link")
+
+    parallel_rmtree(str(root))
+
+    assert not root.exists()
+    assert (target / "file.txt").read_text() == "content"
@@ -1,6 +1,5 @@
 import os
-import shutil
-from wft import WhisperFineTuner
+from wft import WhisperFineTuner, parallel_rmtree
 
 
 def test_whisper_finetuner():
@@ -11,7 +10,7 @@ def test_whisper_finetuner():
         ft = WhisperFineTuner(id)
         ft.training_args.eval_on_start = True
 
-        shutil.rmtree(ft.dir, ignore_errors=True)
+        parallel_rmtree(ft.dir)
         merged_model_path = os.path.join(ft.dir, "merged_model")
 
         ft = (
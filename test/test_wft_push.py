@@ -1,5 +1,4 @@
-import shutil
-from wft import WhisperFineTuner
+from wft import WhisperFineTuner, parallel_rmtree
 
 
 def test_whisper_finetuner():
@@ -9,7 +8,7 @@ def test_whisper_finetuner():
     try:
         ft = WhisperFineTuner(id, org)
 
-        shutil.rmtree(ft.dir, ignore_errors=True)
+        parallel_rmtree(ft.dir)
 
         ft = (
             ft.set_baseline("openai/whisper-tiny", language="en", task="transcribe")
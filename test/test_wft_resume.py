@@ -1,6 +1,5 @@
 import os
-import shutil
-from wft import WhisperFineTuner
+from wft import WhisperFineTuner, parallel_rmtree
 
 
 def test_whisper_finetuner():
@@ -8,20 +7,23 @@ def test_whisper_finetuner():
     id = "test-resume-model"
 
     ft = WhisperFineTuner(id)
-    shutil.rmtree(ft.dir, ignore_errors=True)
+    parallel_rmtree(ft.dir)
     merged_model_path = os.path.join(ft.dir, "merged_model")
 
-    def train(n: int):
-        ft = WhisperFineTuner(id)
-        ft.training_args.num_train_epochs = n
+    # load the baseline and the dataset once, the second run resumes with a warm model
+    ft = (
         ft.set_baseline("openai/whisper-tiny", language="en", task="transcribe")
-        ft.prepare_dataset(
+        .prepare_dataset(
             "hf-internal-testing/librispeech_asr_dummy",
             src_transcription_column="text",
             src_train_split="validation[:4]",
             src_test_split="validation[4:8]",
         )
-        ft.set_metric("wer")
+        .set_metric("wer")
+    )
+
+    def train(n: int):
+        ft.training_args.num_train_epochs = n
         ft.train(resume=True)
         ft.merge_and_save(merged_model_path)
 
@@ -1,3 +1,4 @@
+from concurrent.futures import Future
 from transformers import TrainerCallback
 from transformers.integrations import TensorBoardCallback, rewrite_logs
 from transformers.integrations.integration_utils import logger
@@ -5,9 +6,15 @@ from transformers.trainer_callback import ProgressCallback, TrainerControl, Trai
 from transformers.trainer_pt_utils import IterableDatasetShard
 from transformers.training_args import TrainingArguments
 from torch.utils.data import IterableDataset
+from .utils import write_batch_size_cache
 
 
 class WFTTensorBoardCallback(TensorBoardCallback):
+    def __init__(self, tb_writer=None, flush_every: int = 10):
+        super().__init__(tb_writer)
+        self.flush_every = flush_every
+        self._log_count = 0
+
     def on_log(self, args, state, control, logs=None, **kwargs):
         if not state.is_world_process_zero:
             return
@@ -29,6 +36,15 @@ class WFTTensorBoardCallback(TensorBoardCallback):
                         "This invocation of Tensorboard's writer.add_scalar() "
                         "is incorrect so we dropped this attribute."
                     )
+
+            # the writer flushes on its own in the background, force it only every few logs
+            self._log_count += 1
+            if self._log_count % self.flush_every == 0:
+                self.tb_writer.flush()
+
+    def on_save(self, args, state, control, **kwargs):
+        # keep the event file in sync with the checkpoints that get pushed
+        if self.tb_writer is not None:
             self.tb_writer.flush()
 
 
@@ -41,31 +57,64 @@ class WFTProgressCallback(ProgressCallback):
         if state.is_world_process_zero and self.training_bar is not None:
             # make a shallow copy of logs so we can mutate the fields copied
             # but avoid doing any value pickling.
-            shallow_logs = {}
+            shallow_logs = dict(logs)
             for k, v in logs.items():
-                if isinstance(v, str) and len(v) > self.max_str_len:
+                if type(v) is str and len(v) > self.max_str_len:
                     shallow_logs[k] = f"[String too long to display, length: {len(v)}]"
-                else:
-                    shallow_logs[k] = v
-            _ = shallow_logs.pop("total_flos", None)
+            shallow_logs.pop("total_flos", None)
             # round numbers so that it looks better in console
-            if "epoch" in shallow_logs:
-                shallow_logs["epoch"] = round(shallow_logs["epoch"], 2)
+            epoch = shallow_logs.get("epoch")
+            if epoch is not None:
+                shallow_logs["epoch"] = round(epoch, 2)
             self.training_bar.write(str(shallow_logs))
 
 
 class ShuffleCallback(TrainerCallback):
+    def __init__(self):
+        super().__init__()
+        # dataset id -> "shard" | "iter" | "map", the dataset type never changes during training
+        self._ds_kind_cache: dict[int, str] = {}
+
     def on_epoch_begin(self, args, state, control, train_dataloader, **kwargs):
-        if isinstance(train_dataloader.dataset, IterableDatasetShard):
-            pass  # set_epoch() is handled by the Trainer
-        elif isinstance(train_dataloader.dataset, IterableDataset):
-            train_dataloader.dataset.set_epoch(train_dataloader.dataset._epoch + 1)
+        dataset = train_dataloader.dataset
+        kind = self._ds_kind_cache.get(id(dataset))
+        if kind is None:
+            if isinstance(dataset, IterableDatasetShard):
+                kind = "shard"
+            elif isinstance(dataset, IterableDataset):
+                kind = "iter"
+            else:
+                kind = "map"
+            self._ds_kind_cache[id(dataset)] = kind
+
+        if kind == "iter":
+            dataset.set_epoch(dataset._epoch + 1)
+        # set_epoch() of "shard" is handled by the Trainer, "map" datasets are shuffled by the sampler
 
 
 class PushCallback(TrainerCallback):
     def __init__(self, ft):
         super().__init__()
         self.ft = ft
+        self._pending: Future | None = None
+
+    def wait(self):
+        # block until the background upload started by the last save is done
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def on_step_end(
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        # saving a checkpoint rewrites the files in the output directory, which the
+        # previous upload may still be reading
+        if control.should_save:
+            self.wait()
 
     def on_save(
         self,
@@ -75,4 +124,37 @@ class PushCallback(TrainerCallback):
         **kwargs,
     ):
         if state.is_world_process_zero and args.push_to_hub:
-            self.ft.push_to_hub()
+            # upload in the background so training continues while the checkpoint is pushed
+            self.wait()
+            self._pending = self.ft.push_to_hub(blocking=False)
+
+    def on_train_end(
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        # the final model is saved and pushed right after training, let the last upload finish first
+        self.wait()
+
+
+class BatchSizeCacheCallback(TrainerCallback):
+    def __init__(self, key: str):
+        super().__init__()
+        self.key = key
+        self.saved = False
+
+    def on_step_end(
+        self,
+        args: TrainingArguments,
+        state: TrainerState,
+        control: TrainerControl,
+        **kwargs,
+    ):
+        # the first finished step proves the batch size found by auto_find_batch_size fits
+        if not self.saved and state.is_world_process_zero:
+            write_batch_size_cache(
+                self.key, state.train_batch_size // max(1, args.n_gpu)
+            )
+            self.saved = True
@@ -1,12 +1,15 @@
 import os
 import torch
 import signal
+import logging
+from functools import lru_cache
 from time import time
 from typing import Any, Literal, Callable
 from datasets import DatasetDict
 from transformers import (
+    BitsAndBytesConfig,
     WhisperFeatureExtractor,
-    WhisperTokenizer,
+    WhisperTokenizerFast,
     WhisperProcessor,
     WhisperForConditionalGeneration,
     Seq2SeqTrainingArguments,
@@ -15,21 +18,83 @@ from transformers import (
 from transformers.trainer_utils import get_last_checkpoint
 from transformers.integrations import TensorBoardCallback
 from transformers.trainer_callback import ProgressCallback
+from transformers.utils import (
+    is_bitsandbytes_available,
+    is_flash_attn_2_available,
+    is_torch_tf32_available,
+)
 from accelerate.utils.imports import is_bf16_available, is_cuda_available
-from peft import LoraConfig, PeftMixedModel, get_peft_model
+from peft import (
+    LoraConfig,
+    PeftMixedModel,
+    get_peft_model,
+    prepare_model_for_kbit_training,
+)
+import transformers
+import jiwer
 import evaluate
 from evaluate import EvaluationModule
+from packaging import version
 from huggingface_hub import HfApi
 from .prepare_dataset import prepare_dataset
-from .utils import DataCollatorSpeechSeq2SeqWithPadding
+from .utils import (
+    DataCollatorSpeechSeq2SeqWithPadding,
+    FEATURES_CACHE,
+    read_batch_size_cache,
+)
 from .callbacks import (
     WFTTensorBoardCallback,
     WFTProgressCallback,
     ShuffleCallback,
     PushCallback,
+    BatchSizeCacheCallback,
+)
+
+
+# silent by default, enable with logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# the encoder convolutions always see 30s of audio, so the autotuned cuDNN algorithms are reused every step
+torch.backends.cudnn.benchmark = True
+
+
+@lru_cache(maxsize=4)
+def load_processor(baseline: str, language: str, task: str) -> WhisperProcessor:
+    return WhisperProcessor.from_pretrained(baseline, language=language, task=task)
+
+
+@lru_cache(maxsize=None)
+def load_metric(name: str) -> EvaluationModule:
+    return evaluate.load(name)
+
+
+# same transforms as the evaluate "cer" module, which sums the errors of every pair like jiwer does
+CER_TRANSFORM = jiwer.Compose(
+    [
+        jiwer.RemoveMultipleSpaces(),
+        jiwer.Strip(),
+        jiwer.ReduceToListOfListOfChars(),
+    ]
 )
 
 
+def compute_metric(
+    metric: EvaluationModule, predictions: list[str], references: list[str]
+) -> float:
+    # the evaluate wer/cer modules wrap jiwer but first write the inputs to an Arrow cache and
+    # align them pair by pair, calling jiwer directly gives the same result in one batched call
+    if metric.name == "wer":
+        return jiwer.wer(references, predictions)
+    if metric.name == "cer":
+        return jiwer.cer(
+            references,
+            predictions,
+            reference_transform=CER_TRANSFORM,
+            hypothesis_transform=CER_TRANSFORM,
+        )
+    return metric.compute(predictions=predictions, references=references)
+
+
 class WhisperFineTuner:
     def __init__(self, id: str, org: str | None = None):
         """
@@ -44,7 +109,7 @@ class WhisperFineTuner:
         self.dir = f"./exp/{id}"
         self.baseline: str | None = None
         self.feature_extractor: WhisperFeatureExtractor | None = None
-        self.tokenizer: WhisperTokenizer | None = None
+        self.tokenizer: WhisperTokenizerFast | None = None
         self.processor: WhisperProcessor | None = None
         self.dataset: DatasetDict | None = None
         self.original_dataset: str | None = None
@@ -52,6 +117,11 @@ class WhisperFineTuner:
         self.peft_model: PeftMixedModel | None = None
         self.metric_primary: EvaluationModule | None = None
         self.metric_secondary: EvaluationModule | None = None
+        self.quantization: Literal["int8", "nf4"] | None = None
+        # WFT_COMPILE=1 enables torch.compile without changing the code, same as enable_compile()
+        self.compile_mode: str | None = (
+            "default" if os.environ.get("WFT_COMPILE", "0") == "1" else None
+        )
 
         self.lora_config = LoraConfig(
             r=32,
@@ -64,17 +134,20 @@ class WhisperFineTuner:
 
         self.use_bf16 = is_bf16_available()
         self.use_fp16 = is_cuda_available() if not self.use_bf16 else False
+        self.use_tf32 = is_torch_tf32_available()
 
         self.training_args = Seq2SeqTrainingArguments(
             output_dir=self.dir,
             per_device_train_batch_size=4,
             per_device_eval_batch_size=8,
             auto_find_batch_size=True,
-            gradient_checkpointing=True,
+            gradient_checkpointing=False,
             gradient_checkpointing_kwargs={"use_reentrant": False},
             generation_max_length=128,
             gradient_accumulation_steps=1,
             learning_rate=5e-6,
+            # the fused kernel updates all LoRA parameters at once but is CUDA only
+            optim="adamw_torch_fused" if is_cuda_available() else "adamw_torch",
             warmup_steps=0,
             max_steps=1000,
             eval_strategy="steps",
@@ -87,6 +160,9 @@ class WhisperFineTuner:
             load_best_model_at_end=True,
             bf16=self.use_bf16,
             fp16=self.use_fp16,
+            tf32=self.use_tf32,
+            dataloader_num_workers=min(4, os.cpu_count() or 1),
+            dataloader_pin_memory=True,
             remove_unused_columns=False,
             label_names=["labels"],
             report_to=["tensorboard"],
@@ -101,6 +177,7 @@ class WhisperFineTuner:
         baseline: str,
         language: str,
         task: Literal["transcribe", "translate"] = "transcribe",
+        quantization: Literal["int8", "nf4"] | None = None,
     ):
         """
         Set the baseline model and initialize related components.
@@ -109,18 +186,16 @@ class WhisperFineTuner:
             baseline (str): The name or path of the baseline Whisper model.
             language (str): The target language for the model.
             task (Literal["transcribe", "translate"]): The task to perform (default: "transcribe").
+            quantization (Literal["int8", "nf4"] | None): Load the frozen baseline weights quantized with bitsandbytes to save GPU memory, requires bitsandbytes and CUDA (default: None).
 
         Returns:
             self: The WhisperFineTuner instance.
         """
         self.baseline = baseline
-        self.feature_extractor = WhisperFeatureExtractor.from_pretrained(baseline)
-        self.tokenizer = WhisperTokenizer.from_pretrained(
-            baseline, language=language, task=task
-        )
-        self.processor = WhisperProcessor.from_pretrained(
-            baseline, language=language, task=task
-        )
+        # the processor already bundles the feature extractor and the (fast) tokenizer
+        self.processor = load_processor(baseline, language, task)
+        self.feature_extractor = self.processor.feature_extractor
+        self.tokenizer = self.processor.tokenizer
         dtype = (
             torch.bfloat16
             if self.use_bf16
@@ -128,11 +203,38 @@ class WhisperFineTuner:
             if self.use_fp16
             else torch.float32
         )
+        if quantization == "nf4":
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=dtype,
+                bnb_4bit_use_double_quant=True,
+            )
+        elif quantization == "int8":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            quantization_config = None
+        if quantization_config is not None and (
+            not is_bitsandbytes_available() or not is_cuda_available()
+        ):
+            raise ValueError("Quantization requires bitsandbytes and CUDA.")
+        self.quantization = quantization
+        # FlashAttention-2 is only used with bf16 weights, fp16 and fp32 use the fused SDPA kernels
+        attn_implementation = (
+            "flash_attention_2"
+            if is_flash_attn_2_available() and dtype == torch.bfloat16
+            else "sdpa"
+        )
         self.baseline_model = WhisperForConditionalGeneration.from_pretrained(
-            baseline, load_in_8bit=False, torch_dtype=dtype
+            baseline,
+            torch_dtype=dtype,
+            quantization_config=quantization_config,
+            attn_implementation=attn_implementation,
         )
         self.baseline_model.config.forced_decoder_ids = None
         self.baseline_model.config.suppress_tokens = []
+        # the adapters of the previous baseline do not apply to the new one
+        self.peft_model = None
         return self
 
     def prepare_dataset(
@@ -144,6 +246,11 @@ class WhisperFineTuner:
         src_train_split: str = "train+validation",
         src_test_split: str = "test",
         buffer_size: int = 256,
+        num_proc: int = 4,
+        streaming: bool = False,
+        feature_extractor_device: str = "cpu",
+        cache_features: bool = True,
+        feature_dtype: str = "float16",
     ):
         """
         Prepare the dataset for fine-tuning.
@@ -153,7 +260,14 @@ class WhisperFineTuner:
             src_audio_column (str): The name of the audio column in the source dataset (default: "audio").
             src_transcription_column (str): The name of the transcription column in the source dataset (default: "transcription").
             src_subset (str | None): The subset of the dataset to use, if any (default: None).
+            src_train_split (str): The split(s) to train on, multiple splits can be joined with "+" (default: "train+validation").
+            src_test_split (str): The split to evaluate on (default: "test").
+            buffer_size (int): The shuffle buffer size of the streaming train split (default: 256).
             num_proc (int): The number of processes to use for data preparation (default: 4).
+            streaming (bool): Whether to stream the test split too instead of downloading and processing it up front, the train split is always streamed (default: False).
+            feature_extractor_device (str): The device to compute the log-Mel features of the materialized test split on, e.g. "cuda". The streaming splits are processed in the dataloader workers and always use the CPU (default: "cpu").
+            cache_features (bool): Whether to cache the processed test split under ~/.cache/wft/features and reuse it on the next run (default: True).
+            feature_dtype (str): The dtype to store the log-Mel features of the materialized test split in (default: "float16").
 
         Returns:
             self: The WhisperFineTuner instance.
@@ -170,6 +284,11 @@ class WhisperFineTuner:
             src_train_split=src_train_split,
             src_test_split=src_test_split,
             buffer_size=buffer_size,
+            num_proc=num_proc,
+            cache_dir=FEATURES_CACHE if cache_features else None,
+            streaming=streaming,
+            feature_extractor_device=feature_extractor_device,
+            feature_dtype=feature_dtype,
         )
         self.original_dataset = src_name
         return self
@@ -200,8 +319,8 @@ class WhisperFineTuner:
         Returns:
             self: The WhisperFineTuner instance.
         """
-        self.metric_primary = evaluate.load(metric_type)
-        self.metric_secondary = evaluate.load("cer" if metric_type == "wer" else "wer")
+        self.metric_primary = load_metric(metric_type)
+        self.metric_secondary = load_metric("cer" if metric_type == "wer" else "wer")
         return self
 
     def set_training_args(self, training_args: Seq2SeqTrainingArguments):
@@ -234,10 +353,53 @@ class WhisperFineTuner:
         self.training_args.save_steps = save_steps
         return self
 
+    def enable_compile(self, mode: str = "default"):
+        """
+        Compile the Whisper encoder with torch.compile during training.
+
+        The encoder always receives 30 seconds of padded audio, so its input shape is fixed and it only compiles once.
+
+        Args:
+            mode (str): The torch.compile mode to use (default: "default").
+
+        Returns:
+            self: The WhisperFineTuner instance.
+        """
+        self.compile_mode = mode
+        return self
+
+    def enable_gradient_checkpointing(self):
+        """
+        Recompute activations during the backward pass instead of storing them, trading extra compute for less GPU memory.
+
+        Returns:
+            self: The WhisperFineTuner instance.
+        """
+        self.training_args.gradient_checkpointing = True
+        return self
+
+    def enable_8bit_optim(self):
+        """
+        Use the 8-bit AdamW optimizer from bitsandbytes, which keeps the optimizer states in 8 bits.
+
+        Falls back to the current optimizer if bitsandbytes or CUDA is not available.
+
+        Returns:
+            self: The WhisperFineTuner instance.
+        """
+        if is_bitsandbytes_available() and is_cuda_available():
+            self.training_args.optim = "adamw_bnb_8bit"
+        else:
+            print(
+                f"bitsandbytes with CUDA is not available, keep using {self.training_args.optim}."
+            )
+        return self
+
     def train(
         self,
         training_args: Seq2SeqTrainingArguments | None = None,
         resume: bool = False,
+        force_search: bool = False,
     ):
         """
         Train the model using the prepared dataset and configurations.
@@ -245,6 +407,7 @@ class WhisperFineTuner:
         Args:
             training_args (Seq2SeqTrainingArguments | None): The training arguments to use. If None, uses default arguments.
             resume (bool): Whether to resume training from the last checkpoint (default: False).
+            force_search (bool): Whether to search for the batch size again even if one was found for this GPU and baseline before (default: False).
 
         Returns:
             self: The WhisperFineTuner instance.
@@ -258,19 +421,51 @@ class WhisperFineTuner:
 
         if training_args is not None:
             self.training_args = training_args
-        self.training_args.num_train_epochs = 0
-        print(f"Training arguments: {self.training_args}")
 
-        data_collator = DataCollatorSpeechSeq2SeqWithPadding(self.processor)
+        # keep a few batches per worker ready, the prefetch factor is only valid with worker processes
+        if (
+            self.training_args.dataloader_num_workers > 0
+            and self.training_args.dataloader_prefetch_factor is None
+        ):
+            self.training_args.dataloader_prefetch_factor = 4
+
+        # reuse the batch size auto_find_batch_size found on a previous run instead of probing for OOM again
+        batch_size_key = None
+        if self.training_args.auto_find_batch_size and torch.cuda.is_available():
+            batch_size_key = "|".join(
+                str(part)
+                for part in (
+                    torch.cuda.get_device_name(0),
+                    self.baseline,
+                    self.quantization,
+                    self.training_args.per_device_train_batch_size,
+                    self.training_args.gradient_checkpointing,
+                )
+            )
+            cached_batch_size = read_batch_size_cache().get(batch_size_key)
+            if cached_batch_size is not None and not force_search:
+                print(f"Using cached batch size {cached_batch_size}.")
+                self.training_args.per_device_train_batch_size = cached_batch_size
+                self.training_args.auto_find_batch_size = False
+                batch_size_key = None
+        logger.info(f"Training arguments: {self.training_args}")
+
+        data_collator = DataCollatorSpeechSeq2SeqWithPadding(
+            self.processor, dtype=self.baseline_model.dtype
+        )
         tokenizer = self.tokenizer
         metric_primary = self.metric_primary
         metric_secondary = self.metric_secondary
+        # WFT_LOG_CORRECT=0 leaves the correct predictions out of the logged table
+        log_correct = os.environ.get("WFT_LOG_CORRECT", "1") == "1"
 
         def compute_metrics(pred):
             pred_ids = pred.predictions
             label_ids = pred.label_ids
 
-            # replace -100 with the pad_token_id
+            # replace -100 with the pad_token_id, the predictions are padded with -100 too
+            # when eval batches of different lengths are joined, and the fast tokenizer cannot decode it
+            pred_ids[pred_ids == -100] = tokenizer.pad_token_id
             label_ids[label_ids == -100] = tokenizer.pad_token_id
 
             decode_start = time()
@@ -279,42 +474,53 @@ class WhisperFineTuner:
             decode_runtime = time() - decode_start
 
             metric_primary_start = time()
-            metric_primary_result = 100 * metric_primary.compute(
-                predictions=pred_str, references=label_str
+            metric_primary_result = 100 * compute_metric(
+                metric_primary, pred_str, label_str
             )
             metric_primary_runtime = time() - metric_primary_start
 
             metric_secondary_start = time()
-            metric_secondary_result = 100 * metric_secondary.compute(
-                predictions=pred_str, references=label_str
+            metric_secondary_result = 100 * compute_metric(
+                metric_secondary, pred_str, label_str
             )
             metric_secondary_runtime = time() - metric_secondary_start
 
-            mismatch_table = (
+            # collect the rows in lists and join them once, repeated string concatenation is quadratic
+            mismatch_rows = [
                 "## Incorrect Predictions\n\n"
                 "| i | Label | Prediction |\n| --- | --- | --- |\n"
-            )
-            match_table = (
+            ]
+            match_rows = [
                 "## Correct Predictions\n\n" "| i | Prediction |\n| --- | --- |\n"
-            )
+            ]
 
             for i, (label, pred) in enumerate(zip(label_str, pred_str)):
                 if label != pred:
-                    mismatch_table += f"| {i} | {label} | {pred} |\n"
-                else:
-                    match_table += f"| {i} | {pred} |\n"
+                    mismatch_rows.append(f"| {i} | {label} | {pred} |\n")
+                elif log_correct:
+                    match_rows.append(f"| {i} | {pred} |\n")
 
             # Close details tags
-            mismatch_table += "\n"
-            match_table += "\n"
+            mismatch_table = "".join(mismatch_rows) + "\n"
+            match_table = "".join(match_rows) + "\n"
 
             # Combine both tables
             markdown_table = mismatch_table + "\n" + match_table
 
+            # the table grows with the eval set, keep it out of the log history and write it next to the checkpoints
+            if self.trainer.is_world_process_zero():
+                preds_dir = os.path.join(self.dir, "preds")
+                os.makedirs(preds_dir, exist_ok=True)
+                with open(
+                    os.path.join(preds_dir, f"step-{self.trainer.state.global_step}.md"),
+                    "w",
+                ) as f:
+                    f.write(markdown_table)
+
             return {
                 metric_primary.name: metric_primary_result,
                 metric_secondary.name: metric_secondary_result,
-                "pred": markdown_table,
+                "n_mismatch": len(mismatch_rows) - 1,  # without the header
                 "decode_runtime": decode_runtime,
                 f"{metric_primary.name}_runtime": metric_primary_runtime,
                 f"{metric_secondary.name}_runtime": metric_secondary_runtime,
@@ -343,24 +549,55 @@ class WhisperFineTuner:
             except Exception as e:
                 print(f"Failed to resume training: {e}, starting from scratch.")
                 resume = False
-        self.peft_model = get_peft_model(self.baseline_model, self.lora_config)
+        # get_peft_model injects the adapters into the baseline model in place,
+        # so reuse the existing PEFT model when train() is called again
+        if self.peft_model is None:
+            if self.quantization is not None:
+                self.baseline_model = prepare_model_for_kbit_training(
+                    self.baseline_model,
+                    use_gradient_checkpointing=self.training_args.gradient_checkpointing,
+                    gradient_checkpointing_kwargs=self.training_args.gradient_checkpointing_kwargs,
+                )
+            elif self.training_args.gradient_checkpointing:
+                # the base weights are frozen, so make the checkpointed segments see an input that requires grad
+                self.baseline_model.enable_input_require_grads()
+            self.peft_model = get_peft_model(self.baseline_model, self.lora_config)
+            if self.compile_mode is not None:
+                encoder = self.baseline_model.get_encoder()
+                encoder.forward = torch.compile(
+                    encoder.forward, mode=self.compile_mode, dynamic=False
+                )
         self.peft_model.print_trainable_parameters()
 
+        # `tokenizer` is deprecated in favor of `processing_class` since transformers 4.46
+        if version.parse(transformers.__version__) >= version.parse("4.46.0"):
+            processing_kwargs = {"processing_class": self.processor}
+        else:
+            processing_kwargs = {"tokenizer": self.feature_extractor}
+
         self.trainer = trainer = Seq2SeqTrainer(
             model=self.peft_model,
             args=self.training_args,
             train_dataset=self.dataset["train"],
             eval_dataset=self.dataset["test"],
-            tokenizer=self.feature_extractor,
+            **processing_kwargs,
             data_collator=data_collator,
             compute_metrics=compute_metrics,
             preprocess_logits_for_metrics=preprocess_logits_for_metrics,
         )
         self.peft_model.config.use_cache = False
 
+        def add_callback(callback):
+            # register each kind of callback only once
+            if not any(
+                isinstance(c, type(callback))
+                for c in trainer.callback_handler.callbacks
+            ):
+                trainer.add_callback(callback)
+
         trainer.remove_callback(TensorBoardCallback)
         trainer.remove_callback(ProgressCallback)
-        trainer.add_callback(WFTProgressCallback())
+        add_callback(WFTProgressCallback())
         if (
             isinstance(self.training_args.report_to, list)
             and "tensorboard" in self.training_args.report_to
@@ -368,12 +605,16 @@ class WhisperFineTuner:
             isinstance(self.training_args.report_to, str)
             and self.training_args.report_to == "tensorboard"
         ):
-            trainer.add_callback(WFTTensorBoardCallback())
-        trainer.add_callback(ShuffleCallback())
-        trainer.add_callback(PushCallback(self))
+            add_callback(WFTTensorBoardCallback())
+        add_callback(ShuffleCallback())
+        push_callback = PushCallback(self)
+        add_callback(push_callback)
+        if batch_size_key is not None:
+            add_callback(BatchSizeCacheCallback(batch_size_key))
 
         def signal_handler(sig, frame):
             print("Training stopped by user.")
+            push_callback.wait()
             trainer.save_model()
             print("Model saved locally.")
             if self.org is not None:
@@ -390,54 +631,53 @@ class WhisperFineTuner:
 
         return self
 
-    def push_to_hub(self):
+    def push_to_hub(self, blocking: bool = True):
+        """
+        Push the LoRA model and training logs to the Hugging Face Hub.
+
+        Args:
+            blocking (bool): Whether to wait for the upload to finish. If False, the upload runs in the background and the caller must wait on the returned future before saving again (default: True).
+
+        Returns:
+            Future | None: The pending upload if `blocking` is False.
+        """
         if self.trainer is None:
             raise ValueError("Please train the model first.")
 
         if self.org is not None:
-            # temporarily remove large preds and runtime metrics
-            temp_storage = {
-                "preds": [],
-                "decode_runtime": [],
-                f"{self.metric_primary.name}_runtime": [],
-                f"{self.metric_secondary.name}_runtime": [],
-            }
-            for log in self.trainer.state.log_history:
-                temp_storage["preds"].append(log.pop("eval_pred", None))
-                temp_storage["decode_runtime"].append(log.pop("decode_runtime", None))
-                temp_storage[f"{self.metric_primary.name}_runtime"].append(
-                    log.pop(f"{self.metric_primary.name}_runtime", None)
-                )
-                temp_storage[f"{self.metric_secondary.name}_runtime"].append(
-                    log.pop(f"{self.metric_secondary.name}_runtime", None)
-                )
-
-            self.trainer.push_to_hub(
-                language=self.tokenizer.language,
-                finetuned_from=self.baseline,
-                tasks="automatic-speech-recognition",
-                dataset_tags=self.original_dataset,
-                tags=[
-                    "wft",
-                    "whisper",
-                    "automatic-speech-recognition",
-                    "audio",
-                    "speech",
-                ],
+            # temporarily remove runtime metrics, the trainer prefixes eval metrics with "eval_"
+            keys = (
+                "eval_decode_runtime",
+                f"eval_{self.metric_primary.name}_runtime",
+                f"eval_{self.metric_secondary.name}_runtime",
             )
+            saved = [
+                {k: log.pop(k) for k in keys if k in log}
+                for log in self.trainer.state.log_history
+            ]
 
-            # restore preds and runtime metrics
-            for log, pred, decode_runtime, primary_runtime, secondary_runtime in zip(
-                self.trainer.state.log_history,
-                temp_storage["preds"],
-                temp_storage["decode_runtime"],
-                temp_storage[f"{self.metric_primary.name}_runtime"],
-                temp_storage[f"{self.metric_secondary.name}_runtime"],
-            ):
-                log["eval_pred"] = pred
-                log["decode_runtime"] = decode_runtime
-                log[f"{self.metric_primary.name}_runtime"] = primary_runtime
-                log[f"{self.metric_secondary.name}_runtime"] = secondary_runtime
+            try:
+                result = self.trainer.push_to_hub(
+                    blocking=blocking,
+                    language=self.tokenizer.language,
+                    finetuned_from=self.baseline,
+                    tasks="automatic-speech-recognition",
+                    dataset_tags=self.original_dataset,
+                    tags=[
+                        "wft",
+                        "whisper",
+                        "automatic-speech-recognition",
+                        "audio",
+                        "speech",
+                    ],
+                )
+            finally:
+                # restore runtime metrics even if the push failed
+                for log, metrics in zip(self.trainer.state.log_history, saved):
+                    log.update(metrics)
+
+            if not blocking:
+                return result
 
     def merge(
         self, dtype: torch.dtype | None = None
@@ -445,13 +685,23 @@ class WhisperFineTuner:
         """
         Merge the LoRA weights with the base model.
 
+        The baseline model is merged in place, a later `train()` adds new adapters on top of the merged weights.
+
         Args:
             dtype (torch.dtype | None): The data type to use for the merged model (default: None).
 
         Returns:
             WhisperForConditionalGeneration: The merged model.
         """
+        if self.peft_model is None:
+            raise ValueError("Please train the model first.")
+
         model = self.peft_model.merge_and_unload()
+        # merge_and_unload removes the adapters from the model, the next train() creates new ones
+        self.peft_model = None
+        if self.quantization is not None:
+            # quantized weights cannot be cast, they are saved in their quantized format
+            return model
         if dtype is None:
             dtype = (
                 torch.bfloat16
@@ -1,10 +1,26 @@
-from datasets import IterableDataset, Dataset, Audio, load_dataset, interleave_datasets
-from transformers import WhisperFeatureExtractor, WhisperTokenizer
+import os
+import json
+import shutil
+import hashlib
+import torch
+from datasets import (
+    IterableDataset,
+    Dataset,
+    Audio,
+    Sequence,
+    Value,
+    load_dataset,
+    load_dataset_builder,
+    load_from_disk,
+    interleave_datasets,
+)
+from transformers import WhisperFeatureExtractor, WhisperTokenizerFast
 
 
 def load_streaming_dataset(dataset_name, dataset_config_name, split, **kwargs):
     if "+" in split:
         # load multiple splits separated by the `+` symbol *with* streaming mode
+        split_names = split.split("+")
         dataset_splits = [
             load_dataset(
                 dataset_name,
@@ -13,10 +29,33 @@ def load_streaming_dataset(dataset_name, dataset_config_name, split, **kwargs):
                 streaming=True,
                 **kwargs,
             )
-            for split_name in split.split("+")
+            for split_name in split_names
         ]
-        # interleave multiple splits to form one dataset
-        interleaved_dataset = interleave_datasets(dataset_splits)
+        # interleave multiple splits to form one dataset, sampling each split in proportion
+        # to its size so a small split is not repeated over and over next to a large one
+        try:
+            # load_dataset ignores trust_remote_code, but the builder config rejects it
+            builder_kwargs = {k: v for k, v in kwargs.items() if k != "trust_remote_code"}
+            splits = load_dataset_builder(
+                dataset_name, dataset_config_name, **builder_kwargs
+            ).info.splits
+            sizes = [
+                splits[name].num_examples if splits and name in splits else None
+                for name in split_names
+            ]
+        except Exception as e:
+            print(f"Failed to read the split sizes: {e}, sampling the splits equally.")
+            sizes = [None] * len(split_names)
+        if all(sizes):
+            probabilities = [size / sum(sizes) for size in sizes]
+        else:
+            probabilities = [1.0 / len(split_names)] * len(split_names)
+        interleaved_dataset = interleave_datasets(
+            dataset_splits,
+            probabilities=probabilities,
+            seed=42,
+            stopping_strategy="all_exhausted",
+        )
         return interleaved_dataset
     else:
         # load a single split *with* streaming mode
@@ -26,67 +65,144 @@ def load_streaming_dataset(dataset_name, dataset_config_name, split, **kwargs):
         return dataset
 
 
+def features_cache_key(**kwargs) -> str:
+    # stable hash of everything that affects the extracted features and labels
+    payload = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
 def prepare_dataset(
     src_name: str,
     feature_extractor: WhisperFeatureExtractor,
-    tokenizer: WhisperTokenizer,
+    tokenizer: WhisperTokenizerFast,
     src_audio_column: str = "audio",
     src_transcription_column: str = "transcription",
     src_subset: str | None = None,
     src_train_split: str = "train+validation",
     src_test_split: str = "test",
     buffer_size: int = 256,
+    num_proc: int = 4,
+    cache_dir: str | None = None,
+    streaming: bool = False,
+    feature_extractor_device: str = "cpu",
+    batch_size: int = 64,
+    feature_dtype: str = "float16",
 ):
+    def prepare_dataset(batch, device="cpu"):
+        # extract a whole batch at once, the audio is already resampled to 16kHz
+        arrays = [audio["array"] for audio in batch[src_audio_column]]
+        batch["input_features"] = list(
+            feature_extractor(arrays, sampling_rate=16000, device=device).input_features
+        )
+        batch["labels"] = tokenizer(batch[src_transcription_column]).input_ids
+        batch["labels_length"] = [len(labels) for labels in batch["labels"]]
+        return batch
+
+    def preprocess(dataset, **kwargs):
+        # remove all non-audio/transcription columns
+        dataset = dataset.remove_columns(
+            [
+                col
+                for col in dataset.column_names
+                if col not in [src_audio_column, src_transcription_column]
+            ]
+        )
+        # resample the audio to 16kHz
+        dataset = dataset.cast_column(
+            src_audio_column, Audio(sampling_rate=16000, mono=True)
+        )
+        return dataset.map(
+            prepare_dataset,
+            batched=True,
+            batch_size=batch_size,
+            remove_columns=list(dataset.features),
+            **kwargs,
+        )
+
     train = load_streaming_dataset(
         src_name,
         src_subset,
         split=src_train_split,
         trust_remote_code=True,
     )
-    test = load_dataset(
-        src_name,
-        src_subset,
-        split=src_test_split,
-        trust_remote_code=True,
-    )
-    print("loaded source dataset", train, test)
+    print("loaded source dataset", train)
+    train = preprocess(train)
 
-    # remove all non-audio/transcription columns
-    train = train.remove_columns(
-        [
-            col
-            for col in train.column_names
-            if col not in [src_audio_column, src_transcription_column]
-        ]
-    )
-    test = test.remove_columns(
-        [
-            col
-            for col in test.column_names
-            if col not in [src_audio_column, src_transcription_column]
-        ]
-    )
-
-    # resample the audio to 16kHz
-    train = train.cast_column(src_audio_column, Audio(sampling_rate=16000, mono=True))
-    test = test.cast_column(src_audio_column, Audio(sampling_rate=16000, mono=True))
+    test_cache = None
+    if cache_dir is not None and not streaming:
+        key = features_cache_key(
+            src_name=src_name,
+            src_subset=src_subset,
+            src_split=src_test_split,
+            src_audio_column=src_audio_column,
+            src_transcription_column=src_transcription_column,
+            model=tokenizer.name_or_path,
+            language=tokenizer.language,
+            task=tokenizer.task,
+            feature_dtype=feature_dtype,
+        )
+        test_cache = os.path.join(cache_dir, key)
 
-    def prepare_dataset(batch):
-        audio = batch[src_audio_column]
-        batch["input_features"] = feature_extractor(
-            audio["array"], sampling_rate=audio["sampling_rate"]
-        ).input_features[0]
-        batch["labels"] = tokenizer(batch[src_transcription_column]).input_ids
-        return batch
+    if streaming:
+        # decode the test split lazily as well, nothing is materialized up front
+        test = load_streaming_dataset(
+            src_name,
+            src_subset,
+            split=src_test_split,
+            trust_remote_code=True,
+        )
+        print("loaded source dataset", test)
+        test = preprocess(test)
+    else:
+        test = None
+        if test_cache is not None and os.path.exists(test_cache):
+            try:
+                test = load_from_disk(test_cache)
+                print("loaded cached test features from", test_cache, test)
+            except Exception as e:
+                print(f"Failed to load cached test features: {e}, extracting them again.")
+                test = None
 
-    train = train.map(
-        prepare_dataset,
-        remove_columns=list(train.features),
-    )
-    test = test.map(prepare_dataset, remove_columns=test.column_names)
+        if test is None:
+            test = load_dataset(
+                src_name,
+                src_subset,
+                split=src_test_split,
+                trust_remote_code=True,
+            )
+            print("loaded source dataset", test)
+            if feature_extractor_device == "cpu":
+                # the test split is materialized, so it can be processed in parallel
+                test = preprocess(test, num_proc=num_proc)
+            else:
+                # CUDA cannot be used from forked workers, extract in this process instead
+                test = preprocess(test, fn_kwargs={"device": feature_extractor_device})
+            # store the materialized features in a smaller dtype, the collator casts them to the model dtype
+            test = test.cast_column(
+                "input_features", Sequence(Sequence(Value(feature_dtype)))
+            )
+            # input features are always padded to 30s, so only the labels vary in length,
+            # sorting keeps similar lengths in the same eval batch to reduce padding
+            test = test.sort("labels_length")
+            if test_cache is not None:
+                # save to a temporary directory first so an interrupted save never leaves a broken cache
+                tmp_cache = f"{test_cache}.tmp-{os.getpid()}"
+                test.save_to_disk(tmp_cache)
+                shutil.rmtree(test_cache, ignore_errors=True)
+                os.replace(tmp_cache, test_cache)
 
     train = train.with_format("torch")
-    test = test.with_format("torch")
+    if streaming:
+        test = test.with_format("torch")
+    else:
+        # the torch format turns every float column into float32, keep the stored features in
+        # their smaller dtype so the dataloader moves half the data, the labels stay python lists
+        test = test.with_format(
+            "torch",
+            columns=["input_features"],
+            dtype=getattr(torch, feature_dtype),
+            output_all_columns=True,
+        )
 
     train = train.shuffle(buffer_size=buffer_size, seed=42)
 
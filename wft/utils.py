@@ -1,3 +1,6 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Dict, List, Union
 import torch
@@ -7,6 +10,7 @@ from transformers import WhisperProcessor
 @dataclass
 class DataCollatorSpeechSeq2SeqWithPadding:
     processor: WhisperProcessor
+    dtype: torch.dtype | None = None
 
     def __call__(
         self, features: List[Dict[str, Union[List[int], torch.Tensor]]]
@@ -19,6 +23,9 @@ class DataCollatorSpeechSeq2SeqWithPadding:
         batch = self.processor.feature_extractor.pad(
             input_features, return_tensors="pt"
         )
+        # features may be stored in a smaller dtype, feed them in the dtype of the model
+        if self.dtype is not None:
+            batch["input_features"] = batch["input_features"].to(self.dtype)
 
         # get the tokenized label sequences
         label_features = [{"input_ids": feature["labels"]} for feature in features]
@@ -38,3 +45,72 @@ class DataCollatorSpeechSeq2SeqWithPadding:
         batch["labels"] = labels
 
         return batch
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "wft")
+BATCH_SIZE_CACHE = os.path.join(CACHE_DIR, "bs_cache.json")
+# kept outside the experiment directory, which the Trainer uploads to the Hub
+FEATURES_CACHE = os.path.join(CACHE_DIR, "features")
+
+
+def read_batch_size_cache() -> Dict[str, int]:
+    if not os.path.exists(BATCH_SIZE_CACHE):
+        return {}
+    try:
+        with open(BATCH_SIZE_CACHE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_batch_size_cache(key: str, batch_size: int):
+    cache = read_batch_size_cache()
+    cache[key] = batch_size
+    os.makedirs(os.path.dirname(BATCH_SIZE_CACHE), exist_ok=True)
+    with open(BATCH_SIZE_CACHE, "w") as f:
+        json.dump(cache, f, indent=2)
+
+
+def parallel_rmtree(path: str, max_workers: int = 16):
+    """
+    Remove a directory tree, unlinking its files from multiple threads.
+
+    Errors are ignored, like `shutil.rmtree(path, ignore_errors=True)`.
+
+    Args:
+        path (str): The directory to remove.
+        max_workers (int): The number of threads used to unlink files (default: 16).
+    """
+    if os.path.islink(path):
+        # only remove the link itself, never the tree it points to
+        os.unlink(path)
+        return
+    if not os.path.isdir(path):
+        return
+
+    def remove(file):
+        try:
+            os.remove(file)
+        except OSError:
+            pass
+
+    walk = list(os.walk(path, topdown=False))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for root, _, files in walk:
+            executor.map(remove, [os.path.join(root, name) for name in files])
+
+    # children come before their parents in a bottom-up walk
+    for root, dirs, _ in walk:
+        for name in dirs:
+            subdir = os.path.join(root, name)
+            if os.path.islink(subdir):
+                remove(subdir)
+                continue
+            try:
+                os.rmdir(subdir)
+            except OSError:
+                pass
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass